@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 """
-Synchronous GitHub Actions workflow scraper + Gemini question generator.
+GitHub Actions workflow scraper + Gemini question generator.
 
 Works per-run:
 - Searches GitHub code for .github/workflows/*.yml or .yaml
-- Fetches file content
+- Fetches file contents concurrently over a single pooled aiohttp session
+  (batched GraphQL, falling back to raw.githubusercontent and the contents API)
 - For up to MAX_GEMINI_CALLS_PER_RUN files per run:
-    - Calls Gemini to generate QUESTIONS_PER_WORKFLOW concise questions (varied styles)
-    - Stores {"question":..., "answer": <raw workflow YAML>, meta...} in datasets/dataset_N.json
-    - Marks the item processed in datasets/processed.json if at least one question was created
+    - Calls Gemini once to generate QUESTIONS_PER_WORKFLOW concise questions (varied styles) as a JSON array
+    - Appends {"question":..., "answer": <raw workflow YAML>, meta...} as one line of datasets/dataset_N.jsonl
+    - Marks the item processed in datasets/state.db if at least one question was created
+- Skips files whose exact content (SHA-256) is already in the dataset
 """
 
-import requests
+import asyncio
+import aiohttp
 import os
 import base64
+import hashlib
 import json
+import orjson
+import random
+import re
+import sqlite3
+import subprocess
 import time
+import yaml
 from datetime import datetime
+from urllib.parse import parse_qs, quote, urlsplit
 import google.generativeai as genai
 from google.api_core.exceptions import GoogleAPIError
 
@@ -25,11 +36,40 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN") or os.getenv("GH_TOKEN")
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
 MAX_GEMINI_CALLS_PER_RUN = int(os.getenv("MAX_GEMINI_CALLS_PER_RUN", "5"))
 QUESTIONS_PER_WORKFLOW = int(os.getenv("QUESTIONS_PER_WORKFLOW", "5"))  # default: 5 question styles per workflow
+QUESTION_STYLE_NAMES = ["instruction", "trigger", "parallelism", "secrets", "purpose"]  # style_1..style_5
+# optional comma-separated subset of QUESTION_STYLE_NAMES; defaults to the first QUESTIONS_PER_WORKFLOW.
+# Without "instruction" the prompt carries a compact workflow summary instead of the full YAML
+# (far fewer input tokens); the default set includes it, so the full YAML is sent by default.
+QUESTION_STYLES = [
+    style.strip() for style in os.getenv("QUESTION_STYLES", "").split(",") if style.strip() in QUESTION_STYLE_NAMES
+] or QUESTION_STYLE_NAMES[:QUESTIONS_PER_WORKFLOW]
 DATASET_DIR = "datasets"
+STATE_DB_PATH = os.path.join(DATASET_DIR, "state.db")
+# JSON state files from before state.db; imported and removed on first run
 PROCESSED_PATH = os.path.join(DATASET_DIR, "processed.json")
+CONTENT_HASHES_PATH = os.path.join(DATASET_DIR, "content_hashes.json")
 MAX_ENTRIES_PER_FILE = 1000
+DATASET_WRITE_BUFFER = 1 << 16  # bytes buffered before dataset appends hit the disk
+DATASET_DUMP_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS  # one JSON object per line
 GITHUB_SEARCH_PER_PAGE = 100  # GitHub max
+RATE_LIMIT_MIN_REMAINING = 2  # wait for the reset once fewer requests than this are left
+RATE_LIMIT_MAX_SLEEP = int(os.getenv("RATE_LIMIT_MAX_SLEEP", "300"))  # seconds
+SEARCH_RESULT_CAP = 1000  # the search API never returns more than this per query
+SEARCH_MAX_FILE_SIZE = 384 * 1024  # code search only indexes files smaller than this
+MIN_WORKFLOW_BYTES = int(os.getenv("MIN_WORKFLOW_BYTES", "512"))  # smaller files are mostly stubs and are not searched
+MAX_WORKFLOW_BYTES = int(os.getenv("MAX_WORKFLOW_BYTES", "32768"))  # larger (often generated) workflows are never downloaded
 SEARCH_STARS_FILTER = os.getenv("SEARCH_STARS_FILTER", "").strip()  # optional e.g. "stars:>10"
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "10"))  # max in-flight REST file fetches
+FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", "50"))  # max files per GraphQL request
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+GITHUB_RAW_URL = "https://raw.githubusercontent.com"
+MAX_PARALLEL_GEMINI = int(os.getenv("MAX_PARALLEL_GEMINI", "8"))  # max in-flight Gemini calls (size to QPS quota)
+PIPELINE_QUEUE_SIZE = 32  # fetched workflows waiting for a Gemini consumer
+GEMINI_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+HTTP_POOL_LIMIT = 20
+HTTP_POOL_LIMIT_PER_HOST = 10
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
 
 HEADERS = {}
 if GITHUB_TOKEN:
@@ -48,96 +88,366 @@ else:
 model = genai.GenerativeModel('gemini-2.0-flash')
 
 # ---------- dataset helpers ----------
+# Datasets are JSON Lines (one object per line) so adding an entry is a plain
+# append instead of a parse + rewrite of the whole file.
+def dataset_index(fn):
+    try:
+        return int(fn.split("_")[1].split(".")[0])
+    except:
+        return 0
+
 def list_dataset_files():
-    files = [f for f in os.listdir(DATASET_DIR) if f.startswith("dataset_") and f.endswith(".json")]
-    def idx(fn):
+    files = [f for f in os.listdir(DATASET_DIR) if f.startswith("dataset_") and f.endswith(".jsonl")]
+    return sorted(files, key=dataset_index)
+
+def migrate_json_datasets():
+    """
+    One-off conversion of legacy dataset_N.json arrays into dataset_N.jsonl.
+    The .json file is removed only after its .jsonl counterpart is fully written.
+    """
+    legacy = [f for f in os.listdir(DATASET_DIR) if f.startswith("dataset_") and f.endswith(".json")]
+    for fn in sorted(legacy, key=dataset_index):
+        src = os.path.join(DATASET_DIR, fn)
+        dst = src + "l"
         try:
-            return int(fn.split("_")[1].split(".")[0])
-        except:
-            return 0
-    return sorted(files, key=idx)
-
-def get_current_dataset_path():
-    files = list_dataset_files()
-    if not files:
-        return os.path.join(DATASET_DIR, "dataset_1.json")
-    last = files[-1]
-    path = os.path.join(DATASET_DIR, last)
-    try:
-        with open(path, "r", encoding="utf-8") as fh:
-            arr = json.load(fh)
-    except Exception:
-        arr = []
-    if len(arr) >= MAX_ENTRIES_PER_FILE:
-        idx = int(last.split("_")[1].split(".")[0]) + 1
-        return os.path.join(DATASET_DIR, f"dataset_{idx}.json")
-    return path
-
-def append_to_dataset(obj: dict):
-    path = get_current_dataset_path()
-    try:
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as fh:
-                data = json.load(fh)
+            with open(src, "rb") as fh:
+                arr = orjson.loads(fh.read())
+        except Exception as e:
+            print(f"[migrate] could not read {src}: {e}")
+            continue
+        with open(dst, "wb") as fh:
+            for obj in arr:
+                fh.write(orjson.dumps(obj, option=DATASET_DUMP_OPTIONS))
+        os.remove(src)
+        print(f"[migrate] {src} -> {dst} ({len(arr)} entries)")
+
+def count_entries(path):
+    with open(path, "rb") as fh:
+        return sum(1 for _ in fh)
+
+def dataset_path(idx):
+    return os.path.join(DATASET_DIR, f"dataset_{idx}.jsonl")
+
+class DatasetWriter:
+    """
+    Appends entries to the newest dataset file, rolling over to dataset_{N+1}
+    every MAX_ENTRIES_PER_FILE entries. The current file and its entry count
+    are scanned once at startup and tracked in memory afterwards; the file is
+    kept open with a large write buffer and flushed on roll-over and close().
+    """
+
+    def __init__(self):
+        files = list_dataset_files()
+        self.index = dataset_index(files[-1]) if files else 1
+        self.path = dataset_path(self.index)
+        self.count = count_entries(self.path) if files else 0
+        self.fh = None
+        if self.count >= MAX_ENTRIES_PER_FILE:
+            self._roll()
         else:
-            data = []
-    except Exception:
-        data = []
-    data.append(obj)
-    with open(path, "w", encoding="utf-8") as fh:
-        json.dump(data, fh, indent=2, ensure_ascii=False)
+            self.fh = open(self.path, "ab", buffering=DATASET_WRITE_BUFFER)
+
+    def _roll(self):
+        if self.fh:
+            self.fh.close()
+        self.index += 1
+        self.path = dataset_path(self.index)
+        self.count = 0
+        self.fh = open(self.path, "ab", buffering=DATASET_WRITE_BUFFER)
+
+    def append(self, obj: dict):
+        self.fh.write(orjson.dumps(obj, option=DATASET_DUMP_OPTIONS))
+        self.count += 1
+        if self.count >= MAX_ENTRIES_PER_FILE:
+            self._roll()
+
+    def flush(self):
+        if self.fh:
+            self.fh.flush()
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
 
 # ---------- processed tracking ----------
-def load_processed():
-    if not os.path.exists(PROCESSED_PATH):
-        return set()
+# SHA-256 of a workflow body; used to skip copy-pasted workflows from other
+# repos that are already in the dataset.
+def content_hash(content: str):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def load_legacy_json(path, default):
+    if not os.path.exists(path):
+        return default
     try:
-        with open(PROCESSED_PATH, "r", encoding="utf-8") as fh:
-            arr = json.load(fh)
-            return set(arr)
+        with open(path, "rb") as fh:
+            return orjson.loads(fh.read())
     except Exception:
-        return set()
+        return default
+
+class StateDB:
+    """
+    Run state in SQLite: one row per processed file with the SHA-256 of its
+    content. Lookups go through the primary key / content_sha index instead
+    of loading everything up front.
+    Writes accumulate in an open transaction until commit() (once per page).
+    """
 
-def save_processed(s: set):
-    with open(PROCESSED_PATH, "w", encoding="utf-8") as fh:
-        json.dump(sorted(list(s)), fh, indent=2)
+    def __init__(self, path=STATE_DB_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed("
+            "unique_id TEXT PRIMARY KEY, content_sha TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS processed_content_sha ON processed(content_sha)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        if self.get_meta("migrated") is None:
+            # imports and the marker commit together, so a failed run is retried in full
+            with self.conn:
+                self._migrate()
+                self.set_meta("migrated", 1)
+            self._remove_legacy()
+
+    def _migrate(self):
+        """Import the JSON state files used before state.db and seed content hashes from the dataset."""
+        for unique_id in load_legacy_json(PROCESSED_PATH, []):
+            self.mark_processed(unique_id)
+        for fn in list_dataset_files():
+            with open(os.path.join(DATASET_DIR, fn), "rb") as fh:
+                for lineno, line in enumerate(fh, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        obj = orjson.loads(line)
+                    except orjson.JSONDecodeError as e:
+                        print(f"[migrate] skipping undecodable line {fn}:{lineno}: {e}")
+                        continue
+                    if not isinstance(obj, dict):
+                        continue
+                    self.mark_processed(
+                        f"{obj.get('source')}:{obj.get('path')}",
+                        content_sha=content_hash(obj.get("answer") or ""),
+                    )
+
+    def _remove_legacy(self):
+        for legacy in (PROCESSED_PATH, CONTENT_HASHES_PATH):
+            if os.path.exists(legacy):
+                os.remove(legacy)
+                print(f"[migrate] {legacy} -> {STATE_DB_PATH}")
+
+    def is_processed(self, unique_id):
+        return self.conn.execute(
+            "SELECT 1 FROM processed WHERE unique_id = ?", (unique_id,)
+        ).fetchone() is not None
+
+    def has_content(self, content_sha):
+        return self.conn.execute(
+            "SELECT 1 FROM processed WHERE content_sha = ? LIMIT 1", (content_sha,)
+        ).fetchone() is not None
+
+    def mark_processed(self, unique_id, content_sha=None):
+        self.conn.execute(
+            "INSERT INTO processed(unique_id, content_sha) VALUES (?, ?) "
+            "ON CONFLICT(unique_id) DO UPDATE SET "
+            "content_sha = COALESCE(excluded.content_sha, content_sha)",
+            (unique_id, content_sha),
+        )
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute(
+            "INSERT INTO meta(key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value)),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# ---------- HTTP session ----------
+# Single pooled session shared by every GitHub call so sockets are kept alive
+# across requests. Created in main() because aiohttp needs a running event loop.
+session = None
+
+def create_session():
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector, headers=HEADERS, timeout=HTTP_TIMEOUT, json_serialize=dumps_compact
+    )
+
+def dumps_compact(obj):
+    # request bodies (GraphQL) without the ", " / ": " padding of json.dumps
+    return orjson.dumps(obj).decode("utf-8")
 
 # ---------- GitHub helpers ----------
-def github_search(page=1, per_page=GITHUB_SEARCH_PER_PAGE):
+async def respect_rate_limit(resp):
+    """
+    Sleep only when GitHub asks for it: for Retry-After (secondary limits), or
+    until X-RateLimit-Reset once X-RateLimit-Remaining drops below
+    RATE_LIMIT_MIN_REMAINING. Waits longer than RATE_LIMIT_MAX_SLEEP are not
+    taken; the next request will fail instead. Returns True if it slept.
+    """
+    retry_after = resp.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        delay = int(retry_after)
+    else:
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        if remaining is None or int(remaining) >= RATE_LIMIT_MIN_REMAINING:
+            return False
+        delay = max(0, int(resp.headers.get("X-RateLimit-Reset", "0")) - time.time()) + 1
+    if delay > RATE_LIMIT_MAX_SLEEP:
+        print(f"[rate-limit] {resp.url.path} resets in {delay:.0f}s, longer than RATE_LIMIT_MAX_SLEEP; not waiting")
+        return False
+    print(f"[rate-limit] {resp.url.path}: sleeping {delay:.0f}s")
+    await asyncio.sleep(delay)
+    return True
+
+async def github_search(page=1, per_page=GITHUB_SEARCH_PER_PAGE, size_range=None):
+    """Return (items, total_count) for one page of the workflow code search, optionally limited to a size_range in bytes."""
     # Build query; user can set SEARCH_STARS_FILTER in workflow env
     query_parts = ["path:.github/workflows", "extension:yml", "extension:yaml"]
     if SEARCH_STARS_FILTER:
         query_parts.append(SEARCH_STARS_FILTER)
+    if size_range:
+        query_parts.append(f"size:{size_range[0]}..{size_range[1]}")
     query = " ".join(query_parts)
     url = "https://api.github.com/search/code"
     params = {"q": query, "per_page": per_page, "page": page}
-    resp = requests.get(url, headers=HEADERS, params=params, timeout=30)
-    if resp.status_code == 403:
-        # Rate limit or forbidden
-        reset = resp.headers.get("X-RateLimit-Reset")
-        print(f"[github_search] 403 rate limit. Reset: {reset}. Response: {resp.text}")
-        resp.raise_for_status()
-    resp.raise_for_status()
-    return resp.json().get("items", [])
+    for attempt in range(2):
+        async with session.get(url, params=params) as resp:
+            if resp.status in (403, 429):
+                # Rate limit or forbidden; retry once if GitHub told us how long to wait
+                reset = resp.headers.get("X-RateLimit-Reset")
+                print(f"[github_search] {resp.status} rate limit. Reset: {reset}. Response: {await resp.text()}")
+                if attempt == 0 and await respect_rate_limit(resp):
+                    continue
+            resp.raise_for_status()
+            data = await resp.json()
+            await respect_rate_limit(resp)
+        return data.get("items", []), data.get("total_count", 0)
 
-def fetch_file_contents(contents_url):
-    resp = requests.get(contents_url, headers=HEADERS, timeout=30)
-    if resp.status_code == 404:
-        return None
-    resp.raise_for_status()
-    data = resp.json()
+async def iter_size_shards(lo, hi):
+    """
+    Yield (lo, hi, first_page_items, total_count) for ascending file-size windows
+    covering lo..hi. A window matching more than SEARCH_RESULT_CAP files is
+    bisected until each piece fits under the cap (or is a single byte size).
+    """
+    stack = [(lo, hi)]
+    while stack:
+        lo, hi = stack.pop()
+        items, total = await github_search(page=1, size_range=(lo, hi))
+        if total > SEARCH_RESULT_CAP and hi > lo:
+            mid = (lo + hi) // 2
+            stack.append((mid + 1, hi))
+            stack.append((lo, mid))
+            continue
+        yield lo, hi, items, total
+
+def item_unique_id(item):
+    repo = item.get("repository", {}).get("full_name", "unknown")
+    return f"{repo}:{item.get('path')}"
+
+async def fetch_file_contents(contents_url):
+    async with session.get(contents_url) as resp:
+        if resp.status == 404:
+            return None
+        resp.raise_for_status()
+        data = await resp.json()
+        await respect_rate_limit(resp)
     content_b64 = data.get("content")
     if not content_b64:
         return None
-    try:
-        return base64.b64decode(content_b64).decode("utf-8", errors="ignore")
-    except Exception:
-        return base64.b64decode(content_b64 + "===").decode("utf-8", errors="ignore")
+    # the contents API wraps base64 at 60 columns; strip that and pad deterministically
+    raw = content_b64.replace("\n", "").replace("\r", "")
+    raw += "=" * (-len(raw) % 4)
+    return base64.b64decode(raw, validate=False).decode("utf-8", errors="ignore")
+
+def raw_content_url(item):
+    """raw.githubusercontent URL of a search hit, pinned to the commit in its contents URL (None if unknown)."""
+    ref = parse_qs(urlsplit(item.get("url") or "").query).get("ref", [None])[0]
+    repo = item.get("repository", {}).get("full_name")
+    if not ref or not repo or not item.get("path"):
+        return None
+    return f"{GITHUB_RAW_URL}/{repo}/{ref}/{quote(item['path'])}"
+
+async def fetch_raw_contents(raw_url):
+    """
+    Return file content straight from raw.githubusercontent: plain bytes, no
+    JSON/base64 wrapping. A 404 yields None so the caller can fall back to the
+    contents API.
+    """
+    async with session.get(raw_url) as resp:
+        if resp.status == 404:
+            return None
+        resp.raise_for_status()
+        body = await resp.read()
+        return body.decode("utf-8", errors="ignore")
+
+async def fetch_blobs_graphql(items):
+    """
+    Fetch the text of many workflow files with a single GraphQL request, using
+    aliased repository/object fields keyed by the blob sha from the search hit.
+    Returns {unique_id: text}. Files GraphQL cannot return inline (truncated,
+    binary or missing) are left out so the caller can fall back to REST.
+    """
+    by_repo = {}
+    for item in items:
+        full_name = item.get("repository", {}).get("full_name", "")
+        if "/" in full_name and item.get("sha"):
+            by_repo.setdefault(full_name, []).append(item)
+    if not by_repo:
+        return {}
+
+    aliases = {}
+    repo_fields = []
+    for r, (full_name, repo_items) in enumerate(by_repo.items()):
+        owner, name = full_name.split("/", 1)
+        blob_fields = []
+        for f, item in enumerate(repo_items):
+            blob_fields.append(
+                f"f{f}: object(oid: {json.dumps(item['sha'])}) "
+                "{ ... on Blob { text isTruncated isBinary } }"
+            )
+            aliases[(f"r{r}", f"f{f}")] = item_unique_id(item)
+        repo_fields.append(
+            f"r{r}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) "
+            f"{{ {' '.join(blob_fields)} }}"
+        )
+    query = "query { " + " ".join(repo_fields) + " }"
+
+    async with session.post(GITHUB_GRAPHQL_URL, json={"query": query}) as resp:
+        resp.raise_for_status()
+        payload = await resp.json()
+        await respect_rate_limit(resp)
+    if payload.get("errors"):
+        # partial errors (e.g. a repo went private) still return data for the rest
+        print(f"[graphql] {len(payload['errors'])} error(s), first: {payload['errors'][0].get('message')}")
+
+    data = payload.get("data") or {}
+    texts = {}
+    for (r, f), unique_id in aliases.items():
+        blob = (data.get(r) or {}).get(f) or {}
+        if blob.get("text") is not None and not blob.get("isTruncated") and not blob.get("isBinary"):
+            texts[unique_id] = blob["text"]
+    return texts
 
 # ---------- Gemini call ----------
-def call_gemini(prompt):
+async def call_gemini_async(sem, prompt):
     try:
-        response = model.generate_content(prompt)
+        async with sem:
+            response = await model.generate_content_async(prompt, generation_config=GEMINI_GENERATION_CONFIG)
         # safety check (if the SDK includes safety info)
         try:
             if getattr(response, "candidates", None):
@@ -170,174 +480,471 @@ def call_gemini(prompt):
         print(f"[gemini] Unknown error during API call: {e}")
         return ""
 
+# ---------- workflow summary ----------
+# libyaml's C loader when PyYAML was built with it; same results, much faster
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_SECRET_REF = re.compile(r"secrets\.([A-Za-z_][A-Za-z0-9_]*)")
+
+_MAX_ITEMS = 20  # list entries / mapping keys kept per summary field
+_MAX_TEXT = 200  # characters kept per scalar value
+
+def _keys(value):
+    return sorted(str(k) for k in value)[:_MAX_ITEMS] if isinstance(value, dict) else []
+
+def _items(value):
+    return value if isinstance(value, list) else []
+
+def _mapping(value):
+    return value if isinstance(value, dict) else {}
+
+def _text(value):
+    # scalars only: containers (possibly alias-expanded) are never copied into the summary
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    return str(value)[:_MAX_TEXT]
+
+def _names(value):
+    """Scalar strings from a scalar, a list of scalars (or of one-level mappings, e.g. schedule crons) or a mapping's keys."""
+    if isinstance(value, dict):
+        return _keys(value)
+    names = []
+    for v in value[:_MAX_ITEMS] if isinstance(value, list) else [value]:
+        if isinstance(v, dict):
+            names.extend(t for t in map(_text, list(v.values())[:_MAX_ITEMS]) if t)
+        elif _text(v):
+            names.append(_text(v))
+    return names
+
+def _triggers(on):
+    if not isinstance(on, dict):
+        return _names(on)
+    return {
+        str(event): (
+            {str(k): _names(v) for k, v in list(cfg.items())[:_MAX_ITEMS]}
+            if isinstance(cfg, dict) else _names(cfg)
+        ) or None
+        for event, cfg in list(on.items())[:_MAX_ITEMS]
+    }
+
+def _dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+def summarize_workflow(workflow_yaml: str):
+    """
+    Return a compact JSON summary of a workflow (triggers, jobs with their
+    needs/runner/steps, actions used, env/with keys, referenced secrets) for
+    prompts that do not need the full YAML. None if it is not a parseable
+    workflow or the summary would not be smaller than the YAML itself.
+    """
+    try:
+        doc = yaml.load(workflow_yaml, Loader=_YAML_LOADER)
+    except yaml.YAMLError:
+        return None
+    if not isinstance(doc, dict) or not isinstance(doc.get("jobs"), dict):
+        return None
+
+    summary = {
+        "name": _text(doc.get("name")),
+        # YAML 1.1 reads a bare `on:` key as boolean True
+        "on": _triggers(doc.get("on", doc.get(True))),
+        "env": _keys(doc.get("env")),
+        "secrets": sorted(set(_SECRET_REF.findall(workflow_yaml))),
+        "jobs": {},
+    }
+    # give up as soon as the summary outgrows the YAML (aliases can make it explode)
+    budget = len(workflow_yaml) - len(_dumps(summary))
+    for job_id, job in doc["jobs"].items():
+        if budget <= 0:
+            return None
+        if not isinstance(job, dict):
+            continue
+        steps = []
+        for step in _items(job.get("steps"))[:_MAX_ITEMS * 5]:
+            if not isinstance(step, dict):
+                continue
+            steps.append({
+                k: v for k, v in (
+                    ("name", _text(step.get("name"))),
+                    ("uses", _text(step.get("uses"))),
+                    ("run", "run" in step or None),
+                    ("with", _keys(step.get("with")) or None),
+                    ("env", _keys(step.get("env")) or None),
+                ) if v
+            })
+        job_summary = {
+            k: v for k, v in (
+                ("needs", _names(job.get("needs")) or None),
+                ("runs-on", _names(job.get("runs-on")) or None),
+                ("if", _text(job.get("if"))),
+                ("matrix", _keys(_mapping(job.get("strategy")).get("matrix")) or None),
+                ("uses", _text(job.get("uses"))),
+                ("env", _keys(job.get("env")) or None),
+                ("steps", steps or None),
+            ) if v
+        }
+        job_id = str(job_id)[:_MAX_TEXT]
+        summary["jobs"][job_id] = job_summary
+        budget -= len(_dumps({job_id: job_summary}))
+
+    text = _dumps(summary)
+    return text if len(text) < len(workflow_yaml) else None
+
 # ---------- prompt templates ----------
-def build_question_prompts(workflow_yaml: str, max_questions: int):
+# One prompt per workflow asks for every question style at once as a JSON
+# array. The static parts depend only on QUESTION_STYLES, so they are built
+# once at import and only the workflow YAML (or its summary) is spliced in.
+_STYLE_TASKS = {
+    # Instruction-style: ask an LLM to generate the workflow (good for training)
+    "instruction": "an INSTRUCTION that asks a model to produce a GitHub Actions workflow that performs the same tasks as the given workflow",
+    "trigger": "a question asking what triggers this workflow",
+    "parallelism": "a question asking which jobs or steps run in parallel or depend on others",
+    "secrets": "a question about how environment variables, secrets, or caching/artifacts are used",
+    "purpose": "a question that asks for a short description of the workflow's purpose or main effect",
+}
+
+_YAML_INTRO = "You will be given the contents of a GitHub Actions workflow YAML file.\n"
+_WORKFLOW_START = "--- WORKFLOW START ---\n"
+_WORKFLOW_END = "\n--- WORKFLOW END ---\n\n"
+_SUMMARY_INTRO = (
+    "You will be given a compact JSON summary of a GitHub Actions workflow YAML file\n"
+    "(triggers, jobs with needs/runner/steps, actions used, env/with keys, referenced secrets).\n"
+)
+_SUMMARY_START = "--- WORKFLOW SUMMARY START ---\n"
+_SUMMARY_END = "\n--- WORKFLOW SUMMARY END ---\n\n"
+
+_STYLES_TASK = (
+    "For each style below, generate exactly one concise single-sentence item (no answer), <= 30 words:\n"
+    + "".join(f"- {style}: {_STYLE_TASKS[style]}.\n" for style in QUESTION_STYLES)
+    + f"\nReturn a JSON array of exactly {len(QUESTION_STYLES)} objects with keys \"style\" and \"question\", "
+    "one per style above, in that order. Output only the JSON array.\n\n"
+)
+_PROMPT_PREFIX = _YAML_INTRO + _STYLES_TASK + _WORKFLOW_START
+_SUMMARY_PROMPT_PREFIX = _SUMMARY_INTRO + _STYLES_TASK + _SUMMARY_START
+_PROMPT_SUFFIX = _WORKFLOW_END + "JSON:"
+_SUMMARY_PROMPT_SUFFIX = _SUMMARY_END + "JSON:"
+
+def build_question_prompt(workflow_yaml: str):
+    """
+    Return the single prompt asking Gemini for one item per QUESTION_STYLES entry.
+    The instruction style needs the full YAML; without it the compact summary is
+    sent instead whenever the workflow parses and the summary is the smaller of the two.
     """
-    Return a list of prompt strings (one per question style) up to max_questions.
-    Each prompt asks Gemini to generate exactly one concise question (no answer).
-    The first template is an instruction-style prompt (useful for training generation).
+    if "instruction" not in QUESTION_STYLES:
+        summary = summarize_workflow(workflow_yaml)
+        if summary is not None:
+            return _SUMMARY_PROMPT_PREFIX + summary + _SUMMARY_PROMPT_SUFFIX
+    return _PROMPT_PREFIX + workflow_yaml + _PROMPT_SUFFIX
+
+# first line with any non-whitespace character
+_FIRST_LINE = re.compile(r"[^\n]*\S[^\n]*")
+
+def parse_questions(text: str):
+    """Parse Gemini's JSON array into {style: question}, tolerating code fences around it."""
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        return {}
+    try:
+        arr = orjson.loads(text[start:end + 1])
+    except orjson.JSONDecodeError:
+        return {}
+    questions = {}
+    for obj in arr if isinstance(arr, list) else []:
+        if isinstance(obj, dict) and isinstance(obj.get("question"), str):
+            questions.setdefault(str(obj.get("style", "")).strip().lower(), obj["question"])
+    return questions
+
+# ---------- git ----------
+GIT_IDENTITY = ["-c", "user.name=github-actions[bot]", "-c", "user.email=github-actions[bot]@users.noreply.github.com"]
+GIT_COMMIT_SCRIPT = 'git add -A -- datasets/ && git "$@" commit --no-verify -q -m "Update datasets via collector_sync" && git push -q'
+
+def commit_datasets():
     """
-    templates = [
-        # 1) Instruction-style: ask an LLM to generate the workflow (good for training)
-        (
-            "You will be given the contents of a GitHub Actions workflow YAML file.\n"
-            "Generate exactly one concise single-sentence INSTRUCTION (no answer) that asks a model\n"
-            "to produce a GitHub Actions workflow that performs the same tasks as the given YAML.\n"
-            "Keep it short (<= 30 words). Output only the instruction sentence.\n\n"
-            f"--- WORKFLOW START ---\n{workflow_yaml}\n--- WORKFLOW END ---\n\n"
-            "Instruction:"
-        ),
-        # 2) Trigger question
-        (
-            "You will be given the contents of a GitHub Actions workflow YAML file.\n"
-            "Generate exactly one concise single-sentence question (no answer) asking what triggers this workflow.\n"
-            "Keep it short (<= 30 words). Output only the question.\n\n"
-            f"--- WORKFLOW START ---\n{workflow_yaml}\n--- WORKFLOW END ---\n\n"
-            "Question:"
-        ),
-        # 3) Jobs / parallelism question
-        (
-            "You will be given the contents of a GitHub Actions workflow YAML file.\n"
-            "Generate exactly one concise single-sentence question (no answer) asking which jobs or steps run in parallel or depend on others.\n"
-            "Keep it short (<= 30 words). Output only the question.\n\n"
-            f"--- WORKFLOW START ---\n{workflow_yaml}\n--- WORKFLOW END ---\n\n"
-            "Question:"
-        ),
-        # 4) Secrets/env/caching question
-        (
-            "You will be given the contents of a GitHub Actions workflow YAML file.\n"
-            "Generate exactly one concise single-sentence question (no answer) about how environment variables, secrets, or caching/artifacts are used.\n"
-            "Keep it short (<= 30 words). Output only the question.\n\n"
-            f"--- WORKFLOW START ---\n{workflow_yaml}\n--- WORKFLOW END ---\n\n"
-            "Question:"
-        ),
-        # 5) Purpose/summary question (what is the high-level purpose)
-        (
-            "You will be given the contents of a GitHub Actions workflow YAML file.\n"
-            "Generate exactly one concise single-sentence question (no answer) that asks for a short description of the workflow's purpose or main effect.\n"
-            "Keep it short (<= 30 words). Output only the question.\n\n"
-            f"--- WORKFLOW START ---\n{workflow_yaml}\n--- WORKFLOW END ---\n\n"
-            "Question:"
-        ),
-    ]
-
-    # Return up to max_questions templates
-    return templates[:max_questions]
+    Stage (datasets/ only), commit without hooks and push in one git shell
+    process. Its output goes to the job log; a non-zero exit is reported.
+    """
+    try:
+        proc = subprocess.run(["sh", "-c", GIT_COMMIT_SCRIPT, "git-commit", *GIT_IDENTITY])
+    except Exception as e:
+        print(f"[git fallback] {e}")
+        return
+    if proc.returncode:
+        print(f"[git fallback] add/commit/push exited with {proc.returncode}")
 
 # ---------- main flow ----------
-def main():
-    print("[start] collector_sync")
-    processed = load_processed()
-    gemini_used = 0
-    page = 1
-    total_added = 0
-
-    # Keep searching pages until gemini budget exhausted or no more items
-    while gemini_used < MAX_GEMINI_CALLS_PER_RUN:
+async def fetch_item_contents(sem, item):
+    raw_url = raw_content_url(item)
+    async with sem:
+        content = None
+        if raw_url:
+            content = await fetch_raw_contents(raw_url)
+        if content is None:
+            # contents API url returned by search
+            content = await fetch_file_contents(item.get("url"))
+    return content
+
+async def fetch_batch_contents(sem, batch):
+    """
+    Return file contents aligned with batch (str, None or the raised Exception).
+    Uses one GraphQL request for the whole batch; files it missed are read from
+    raw.githubusercontent, then the REST contents API if that 404s.
+    """
+    texts = {}
+    if GITHUB_TOKEN:  # the GraphQL API does not accept anonymous requests
         try:
-            items = github_search(page=page)
+            texts = await fetch_blobs_graphql(batch)
         except Exception as e:
-            print(f"[error] github_search page {page}: {e}")
-            break
-
-        if not items:
-            print("[done] no more search items")
-            break
-
-        for item in items:
-            if gemini_used >= MAX_GEMINI_CALLS_PER_RUN:
-                break
-
-            repo = item.get("repository", {}).get("full_name", "unknown")
-            path = item.get("path")
-            unique_id = f"{repo}:{path}"
-            if unique_id in processed:
-                # already handled previously
-                continue
-
-            contents_url = item.get("url")  # contents API url returned by search
-            try:
-                content = fetch_file_contents(contents_url)
-            except Exception as e:
-                print(f"[error] fetch_file_contents {unique_id}: {e}")
-                continue
+            print(f"[error] graphql batch of {len(batch)} files: {e}")
+
+    missing = [item for item in batch if item_unique_id(item) not in texts]
+    fallback = await asyncio.gather(
+        *(fetch_item_contents(sem, item) for item in missing),
+        return_exceptions=True,
+    )
+    for item, content in zip(missing, fallback):
+        texts[item_unique_id(item)] = content
+    return [texts[item_unique_id(item)] for item in batch]
+
+async def generate_questions(sem, writer, item, content, prompt):
+    """
+    Ask Gemini for all question styles of one workflow in a single call and
+    append each usable question. Returns the number of dataset entries created.
+    """
+    repo = item.get("repository", {}).get("full_name", "unknown")
+    path = item.get("path")
+    unique_id = item_unique_id(item)
+    try:
+        response = await call_gemini_async(sem, prompt)
+    except Exception as e:
+        print(f"[error] gemini API call for {unique_id}: {e}")
+        return 0
+
+    questions = parse_questions(response) if response else {}
+    if not questions:
+        print(f"[skip] no usable gemini response for {unique_id}")
+        return 0
+
+    created_count_for_file = 0
+    for style in QUESTION_STYLES:
+        q_text = questions.get(style, "").strip()
+        if not q_text:
+            print(f"[skip] no {style} question from gemini for {unique_id}")
+            continue
+
+        # sanitize question: take first non-empty line
+        m = _FIRST_LINE.search(q_text)
+        q_line = m.group(0).strip() if m else q_text
+        # Ensure question is not absurdly long; truncate politely if needed
+        if len(q_line) > 400:
+            cut = q_line.rfind(" ", 0, 397)
+            q_line = (q_line[:cut] if cut > 0 else q_line[:397]) + "..."
+
+        qa_obj = {
+            "question": q_line,
+            "answer": content,
+            "source": repo,
+            "path": path,
+            "url": item.get("html_url", item.get("url")),
+            "retrieved_at": datetime.utcnow().isoformat() + "Z",
+            "question_style": f"style_{QUESTION_STYLE_NAMES.index(style) + 1}"
+        }
 
-            if not content:
-                print(f"[skip] empty content for {unique_id}")
-                # do NOT mark as processed, so future runs can try again
-                continue
+        try:
+            writer.append(qa_obj)
+            created_count_for_file += 1
+            print(f"[added] {unique_id} (question #{created_count_for_file} for this file)")
+        except Exception as e:
+            print(f"[error] dataset append for {unique_id}: {e}")
+            # do not mark processed if write fails for this question entry
+            # continue to next question
 
-            # Build up to QUESTIONS_PER_WORKFLOW different prompts (instruction + how/what variants)
-            prompts = build_question_prompts(content, QUESTIONS_PER_WORKFLOW)
+    return created_count_for_file
 
-            successful_any = False
-            created_count_for_file = 0
+class CollectorPipeline:
+    """
+    Producer/consumer run loop. One producer walks the search shards/pages and
+    fetches file contents into a bounded queue; MAX_PARALLEL_GEMINI consumers
+    turn queued workflows into questions. GitHub fetches and Gemini calls thus
+    overlap instead of alternating. Every file handed to Gemini uses up one
+    call of MAX_GEMINI_CALLS_PER_RUN, whether or not it yields questions, and
+    files are only queued while budget is left for them (counting the ones
+    still in flight), so a failing key or quota cannot stretch a run.
+    """
 
-            for idx, prompt in enumerate(prompts):
-                if gemini_used >= MAX_GEMINI_CALLS_PER_RUN:
-                    print("[limit] reached MAX_GEMINI_CALLS_PER_RUN, stopping additional Gemini calls")
+    def __init__(self, state, writer):
+        self.state = state
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.fetch_sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        self.gemini_sem = asyncio.Semaphore(MAX_PARALLEL_GEMINI)
+        self.inflight = 0  # files queued or being processed by a consumer
+        self.inflight_hashes = set()
+        self.gemini_used = 0
+        self.total_added = 0
+
+    async def run(self):
+        consumers = [asyncio.create_task(self.consumer()) for _ in range(MAX_PARALLEL_GEMINI)]
+        try:
+            await self.producer()
+            await self.queue.join()
+        finally:
+            for task in consumers:
+                task.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            self.commit()
+
+    def commit(self):
+        # dataset lines must reach disk before the state rows that point at them are committed
+        self.writer.flush()
+        self.state.commit()
+
+    def open_slots(self):
+        """Number of files that may still be queued without overshooting MAX_GEMINI_CALLS_PER_RUN."""
+        return max(0, MAX_GEMINI_CALLS_PER_RUN - self.gemini_used - self.inflight)
+
+    async def producer(self):
+        # The search API stops at 1000 results per query, so the corpus is walked
+        # in file-size windows between MIN_WORKFLOW_BYTES and MAX_WORKFLOW_BYTES.
+        # A single byte size can hold more than 1000 hits and a run only uses a
+        # few files, so always starting at the bottom would only ever sample the
+        # smallest workflows. Each run instead starts at a size drawn
+        # log-uniformly from that range, walks upward and wraps to the bottom;
+        # already-processed hits are skipped without fetching.
+        max_size = min(SEARCH_MAX_FILE_SIZE, MAX_WORKFLOW_BYTES)
+        min_size = min(MIN_WORKFLOW_BYTES, max_size)
+        floor = max(min_size, 1)
+        start = int(floor * (max_size / floor) ** random.random())
+        print(f"[start] size walk from {start} bytes")
+        for lo, hi in ((start, max_size), (min_size, start - 1)):
+            if lo > hi:
+                continue
+            if not await self.walk_shards(lo, hi):
+                return
+        print("[done] no more search items")
+
+    async def walk_shards(self, lo, hi):
+        """Queue the hits of every size shard in lo..hi. Returns False once the run should stop."""
+        # Keep searching shards/pages until gemini budget exhausted or no more items
+        shards = iter_size_shards(lo, hi)
+        while self.open_slots():
+            try:
+                lo, hi, items, total = await anext(shards)
+            except StopAsyncIteration:
+                return True
+            except Exception as e:
+                print(f"[error] github_search from size:{lo}: {e}")
+                return False
+
+            print(f"[shard] size:{lo}..{hi} ({total} results)")
+            last_page = -(-min(total, SEARCH_RESULT_CAP) // GITHUB_SEARCH_PER_PAGE)
+            page = 1
+            while items:
+                if not await self.produce_page(items):
+                    return False
+                self.commit()
+                if page >= last_page:
                     break
 
+                page += 1
                 try:
-                    q_text = call_gemini(prompt)
+                    items, _ = await github_search(page=page, size_range=(lo, hi))
                 except Exception as e:
-                    print(f"[error] gemini API call for {unique_id}: {e}")
-                    # try next prompt; do not mark processed yet
+                    print(f"[error] github_search size:{lo}..{hi} page {page}: {e}")
+                    return False
+        return False
+
+    async def produce_page(self, items):
+        """
+        Fetch the unprocessed items of one search page and queue them for the
+        consumers. Returns False once the Gemini budget is used up.
+        """
+        # skip items already handled previously (or too big, when search reports a size)
+        # before spending a fetch on them
+        pending = [
+            item for item in items
+            if not self.state.is_processed(item_unique_id(item))
+            and int(item.get("size") or item.get("file_size") or 0) <= MAX_WORKFLOW_BYTES
+        ]
+
+        pos = 0
+        while pos < len(pending):
+            slots = self.open_slots()
+            if not slots:
+                print("[limit] reached MAX_GEMINI_CALLS_PER_RUN, stopping additional Gemini calls")
+                return False
+
+            # Fetch only as many files as the remaining Gemini budget can use
+            # (capped at FETCH_BATCH_SIZE per GraphQL request).
+            batch = pending[pos:pos + min(FETCH_BATCH_SIZE, slots)]
+            pos += len(batch)
+            contents = await fetch_batch_contents(self.fetch_sem, batch)
+
+            for item, content in zip(batch, contents):
+                unique_id = item_unique_id(item)
+                if isinstance(content, Exception):
+                    print(f"[error] fetch_file_contents {unique_id}: {content}")
                     continue
 
-                if not q_text:
-                    print(f"[skip] empty gemini response for {unique_id} (prompt idx {idx})")
+                if not content:
+                    print(f"[skip] empty content for {unique_id}")
+                    # do NOT mark as processed, so future runs can try again
                     continue
 
-                # sanitize question: take first non-empty line
-                q_line = next((line for line in q_text.splitlines() if line.strip()), q_text.strip())
-                q_line = q_line.strip()
-                # Ensure question is not absurdly long; truncate politely if needed
-                if len(q_line) > 400:
-                    q_line = q_line[:397].rsplit(" ", 1)[0] + "..."
-
-                qa_obj = {
-                    "question": q_line,
-                    "answer": content,
-                    "source": repo,
-                    "path": path,
-                    "url": item.get("html_url", contents_url),
-                    "retrieved_at": datetime.utcnow().isoformat() + "Z",
-                    "question_style": f"style_{idx+1}"
-                }
-
-                try:
-                    append_to_dataset(qa_obj)
-                    created_count_for_file += 1
-                    gemini_used += 1
-                    successful_any = True
-                    total_added += 1
-                    print(f"[added] {unique_id} (question #{created_count_for_file} for this file, gemini {gemini_used}/{MAX_GEMINI_CALLS_PER_RUN})")
-                except Exception as e:
-                    print(f"[error] append_to_dataset for {unique_id}: {e}")
-                    # do not mark processed if write fails for this question entry
-                    # continue to next prompt
-
-            # Mark the file as processed only if we successfully created at least one question
-            if successful_any:
-                processed.add(unique_id)
+                digest = content_hash(content)
+                if self.state.has_content(digest):
+                    print(f"[skip] duplicate content already in dataset: {unique_id}")
+                    self.state.mark_processed(unique_id, digest)
+                    continue
+                if digest in self.inflight_hashes:
+                    # identical copy already queued; leave it for a later run in case the first copy fails
+                    print(f"[skip] duplicate content already queued: {unique_id}")
+                    continue
 
-        page += 1
-        time.sleep(1)  # small delay between pages to avoid hitting GitHub rate limits
+                self.inflight += 1
+                self.inflight_hashes.add(digest)
+                await self.queue.put((item, content, digest))
+        return True
 
-    save_processed(processed)
-    print(f"[finished] gemini_used={gemini_used}, total_added={total_added}")
+    async def consumer(self):
+        while True:
+            item, content, digest = await self.queue.get()
+            unique_id = item_unique_id(item)
+            try:
+                # One prompt covering every question style (instruction + how/what variants)
+                prompt = build_question_prompt(content)
+                created_count_for_file = await generate_questions(self.gemini_sem, self.writer, item, content, prompt)
+                # Mark the file as processed only if we successfully created at least one question
+                if created_count_for_file:
+                    self.state.mark_processed(unique_id, digest)
+                    self.total_added += created_count_for_file
+            except Exception as e:
+                print(f"[error] generating questions for {unique_id}: {e}")
+            finally:
+                # failed files still count, so the budget bounds the calls actually made
+                self.gemini_used += 1
+                print(f"[progress] gemini {self.gemini_used}/{MAX_GEMINI_CALLS_PER_RUN}, total_added={self.total_added}")
+                self.inflight -= 1
+                self.inflight_hashes.discard(digest)
+                self.queue.task_done()
+
+async def main():
+    global session
+    print("[start] collector_sync")
+    migrate_json_datasets()
+    writer = DatasetWriter()
+    state = StateDB()
+    session = create_session()
+    pipeline = CollectorPipeline(state, writer)
 
-    # optional: try to commit from script, but workflow will also commit
     try:
-        import subprocess, shlex
-        subprocess.run(shlex.split('git config --global user.name "github-actions[bot]"'), check=False)
-        subprocess.run(shlex.split('git config --global user.email "github-actions[bot]@users.noreply.github.com"'), check=False)
-        subprocess.run("git add datasets/*.json || true", shell=True, check=False)
-        subprocess.run("git commit -m \"Update datasets via collector_sync\" || true", shell=True, check=False)
-        subprocess.run("git push || true", shell=True, check=False)
-    except Exception as e:
-        print(f"[git fallback] {e}")
+        await pipeline.run()
+    finally:
+        await session.close()
+        writer.close()
+        state.close()
+
+    print(f"[finished] gemini_used={pipeline.gemini_used}, total_added={pipeline.total_added}")
+    # optional: commit from script, but workflow will also commit
+    commit_datasets()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())